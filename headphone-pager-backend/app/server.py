@@ -1,74 +1,132 @@
 
 import os
-import subprocess
+import shutil
 import time
 import tempfile
-import json
-import uuid
 import asyncio
+import gzip
+import hashlib
+import hmac
+import logging
+import secrets
 import sqlite3
-from datetime import datetime, timedelta, timezone
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional, Literal, Dict, Any
+from typing import Optional, Literal, Dict, Union
 # -----------------------------
 # Audio conversion (server-side)
 # -----------------------------
 def _ffmpeg_path() -> str:
     return os.environ.get("FFMPEG_PATH", "ffmpeg")
 
-def convert_to_wav_bytes(input_bytes: bytes, input_ext: str = ".bin") -> bytes:
-    """Convert arbitrary audio bytes to WAV (PCM s16le, 48kHz, stereo) using ffmpeg."""
-    with tempfile.TemporaryDirectory() as td:
-        in_path = Path(td) / f"in{input_ext or '.bin'}"
-        out_path = Path(td) / "out.wav"
-        in_path.write_bytes(input_bytes)
-
-        cmd = [
-            _ffmpeg_path(),
-            "-y",
-            "-i", str(in_path),
-            "-vn",
-            "-ac", "2",
-            "-ar", "48000",
-            "-c:a", "pcm_s16le",
-            "-f", "wav",
-            str(out_path),
-        ]
-        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if proc.returncode != 0:
-            raise HTTPException(status_code=500, detail=f"ffmpeg conversion failed: {proc.stderr.decode('utf-8', errors='ignore')[:1200]}")
-        wav = out_path.read_bytes()
-
-    if len(wav) < 12 or wav[0:4] != b"RIFF" or wav[8:12] != b"WAVE":
-        raise HTTPException(status_code=500, detail="Converted audio is not a valid WAV (RIFF/WAVE header missing)")
-    return wav
-
-
-
-def _ffmpeg_path() -> str:
-    return os.environ.get("FFMPEG_PATH", "ffmpeg")
-
-def _is_wav_filename(name: str) -> bool:
-    return name.lower().endswith(".wav")
-
-def convert_to_wav(input_path: str, output_path: str) -> None:
-    """Convert arbitrary audio file to WAV (PCM s16le, 48kHz, stereo) using ffmpeg."""
-    cmd = [
+def _has_wav_header(buf: bytes) -> bool:
+    # startswith() with an offset compares in place; slicing would copy
+    return buf.startswith(b"RIFF") and buf.startswith(b"WAVE", 8)
+
+def _is_target_wav(buf: bytes) -> bool:
+    """True if buf already is a WAV in the output format (PCM s16le, 48kHz, stereo)."""
+    if not _has_wav_header(buf):
+        return False
+    # Walk the RIFF chunks up to "fmt " (usually the first one).
+    pos = 12
+    while pos + 8 <= len(buf):
+        (chunk_size,) = struct.unpack_from("<I", buf, pos + 4)
+        if buf.startswith(b"fmt ", pos):
+            if chunk_size < 16 or pos + 24 > len(buf):
+                return False
+            audio_format, channels, sample_rate, _, _, bits = struct.unpack_from("<HHIIHH", buf, pos + 8)
+            return audio_format == 1 and channels == 2 and sample_rate == 48000 and bits == 16
+        pos += 8 + chunk_size + (chunk_size & 1)
+    return False
+
+def _ffmpeg_wav_cmd(input_path: str, output_path: str) -> list[str]:
+    return [
         _ffmpeg_path(),
+        "-hide_banner",
+        "-nostdin",
+        "-loglevel", "error",
         "-y",
+        "-threads", "1",
         "-i", input_path,
+        "-vn",
         "-ac", "2",
         "-ar", "48000",
         "-c:a", "pcm_s16le",
         output_path,
     ]
-    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if proc.returncode != 0:
-        raise RuntimeError(f"ffmpeg failed: {proc.stderr.decode('utf-8', errors='ignore')[:4000]}")
 
+def _needs_seekable_input(head: bytes) -> bool:
+    # MP4/MOV/M4A/3GP ("ftyp" box; or a bare "moov"/"mdat" first) often keep
+    # their index at the end, so ffmpeg can't demux them from a pipe.
+    return head[4:8] in (b"ftyp", b"moov", b"mdat", b"wide", b"free")
+
+def _check_wav_output(returncode: int, stderr: bytes, output_path: str) -> None:
+    if returncode != 0:
+        Path(output_path).unlink(missing_ok=True)
+        raise HTTPException(status_code=500, detail=f"ffmpeg conversion failed: {stderr.decode('utf-8', errors='ignore')[:1200]}")
+    with open(output_path, "rb") as f:
+        head = f.read(12)
+    if not _has_wav_header(head):
+        Path(output_path).unlink(missing_ok=True)
+        raise HTTPException(status_code=500, detail="Converted audio is not a valid WAV (RIFF/WAVE header missing)")
+
+async def convert_stream_to_wav(src, output_path: str) -> None:
+    """Feed an upload to ffmpeg over stdin, writing the WAV blob at output_path.
 
-from fastapi import FastAPI, Depends, HTTPException, Request, UploadFile, File
-from fastapi.responses import HTMLResponse, FileResponse, Response
+    src is anything with an async read(n) (e.g. UploadFile). Saves spooling the
+    upload to a temp file first; the output stays a real file so ffmpeg can
+    seek back and fill in the RIFF sizes. Callers route formats that need a
+    seekable input (see _needs_seekable_input) through convert_file_to_wav.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *_ffmpeg_wav_cmd("pipe:0", output_path),
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+    async def feed() -> None:
+        try:
+            while chunk := await src.read(UPLOAD_CHUNK_BYTES):
+                proc.stdin.write(chunk)
+                await proc.stdin.drain()
+            proc.stdin.close()
+            await proc.stdin.wait_closed()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ffmpeg gave up early; its exit status and stderr say why
+
+    # Drain stderr while feeding so a chatty ffmpeg can't block on a full pipe
+    _, stderr = await asyncio.gather(feed(), proc.stderr.read())
+    _check_wav_output(await proc.wait(), stderr, output_path)
+
+async def convert_file_to_wav(input_path: str, output_path: str) -> None:
+    """Turn an uploaded file on disk into the WAV blob at output_path.
+
+    Works file-to-file so neither the upload nor the WAV is ever held in memory,
+    and awaits ffmpeg as an asyncio subprocess instead of blocking a thread.
+    """
+    with open(input_path, "rb") as f:
+        head = f.read(4096)
+    if _is_target_wav(head):
+        os.replace(input_path, output_path)
+        return
+    proc = await asyncio.create_subprocess_exec(
+        *_ffmpeg_wav_cmd(input_path, output_path),
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await proc.communicate()
+    _check_wav_output(proc.returncode, stderr, output_path)
+
+
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, UploadFile, File
+from fastapi.responses import HTMLResponse, FileResponse, ORJSONResponse, Response
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
 
@@ -81,24 +139,53 @@ ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
 DEFAULT_MESSAGE_TTL_SECONDS = int(os.getenv("DEFAULT_MESSAGE_TTL_SECONDS", "600"))  # 10 min
 PAIRING_CODE_TTL_SECONDS = int(os.getenv("PAIRING_CODE_TTL_SECONDS", "300"))        # 5 min
 LONGPOLL_TIMEOUT_SECONDS = int(os.getenv("LONGPOLL_TIMEOUT_SECONDS", "45"))
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+UPLOAD_CHUNK_BYTES = 1 << 20
+PENDING_UPLOAD_TTL_SECONDS = 3600  # chunked uploads idle (no init/PUT) this long are dropped
+MAX_UPLOAD_CHUNKS = 4096
+FFMPEG_CONCURRENCY = int(os.getenv("FFMPEG_CONCURRENCY", str(os.cpu_count() or 1)))
 BASE_URL = os.getenv("BASE_URL", "")
+# When set (e.g. "/_protected_blobs"), audio downloads that came through the
+# reverse proxy (it adds "X-Accel-Enabled: 1") are handed back to it via
+# X-Accel-Redirect instead of being streamed through Python. Direct requests,
+# e.g. agents on :8585, still get the file from here.
+ACCEL_REDIRECT_PREFIX = os.getenv("ACCEL_REDIRECT_PREFIX", "").rstrip("/")
+# Key for signed audio URLs. Unset means a fresh key per process: URLs handed out
+# before a restart then just fall back to bearer auth.
+AUDIO_URL_SECRET = os.getenv("AUDIO_URL_SECRET", "").encode() or secrets.token_bytes(32)
+
+log = logging.getLogger("headphone_pager")
 
 if not ADMIN_TOKEN:
     # Allow running locally without env, but strongly recommend setting it.
     # In Docker, provide ADMIN_TOKEN.
     ADMIN_TOKEN = "dev-admin-token-change-me"
 
+# Admission control for conversions: at most one single-threaded ffmpeg per core
+_FFMPEG_SEM = asyncio.Semaphore(max(1, FFMPEG_CONCURRENCY))
+
 Path(BLOB_DIR).mkdir(parents=True, exist_ok=True)
+PENDING_UPLOAD_DIR = Path(BLOB_DIR) / "pending"
 Path(DB_PATH).parent.mkdir(parents=True, exist_ok=True)
 
 # -----------------------------
 # Utilities
 # -----------------------------
-def utcnow() -> datetime:
-    return datetime.now(timezone.utc)
+def now_ms() -> int:
+    return time.time_ns() // 1_000_000
+
+def dt_to_ms(dt: datetime) -> int:
+    return int(dt.timestamp() * 1000)
+
+@lru_cache(maxsize=4096)
+def _iso_second(sec: int) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(sec))
 
-def dt_to_iso(dt: datetime) -> str:
-    return dt.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
+def ms_to_iso(ms: int) -> str:
+    # Always millisecond precision, e.g. 2024-05-01T12:00:00.250Z; the
+    # seconds prefix is shared by most timestamps in a response, so cache it.
+    sec, msec = divmod(ms, 1000)
+    return f"{_iso_second(sec)}.{msec:03d}Z"
 
 def iso_to_dt(s: str) -> datetime:
     # Accept Z or offset
@@ -108,151 +195,441 @@ def iso_to_dt(s: str) -> datetime:
 
 def new_token(nbytes: int = 32) -> str:
     # URL-safe token
-    return uuid.uuid4().hex + uuid.uuid4().hex
+    return secrets.token_urlsafe(nbytes)
+
+def new_id() -> str:
+    # 32 hex chars; existing rows keep their hyphenated uuid4 ids
+    return secrets.token_hex(16)
 
 def new_pairing_code() -> str:
     # 6-digit code; avoid leading zeros? keep simple.
-    import secrets
     return f"{secrets.randbelow(1_000_000):06d}"
 
+_CT_TO_EXT = {
+    "audio/webm": ".webm",
+    "audio/wav": ".wav",
+    "audio/x-wav": ".wav",
+    "audio/mpeg": ".mp3",
+    "audio/ogg": ".ogg",
+}
+
 def safe_ext(content_type: str, filename: str) -> str:
     # best-effort extension
-    ext = ""
-    if filename:
-        ext = Path(filename).suffix.lower()
-        if len(ext) > 8:
-            ext = ""
-    if not ext:
-        if content_type == "audio/webm":
-            ext = ".webm"
-        elif content_type in ("audio/wav", "audio/x-wav"):
-            ext = ".wav"
-        elif content_type == "audio/mpeg":
-            ext = ".mp3"
-        elif content_type == "audio/ogg":
-            ext = ".ogg"
-    return ext or ".bin"
+    ext = Path(filename).suffix.lower() if filename else ""
+    if len(ext) > 8:
+        ext = ""
+    return ext or _CT_TO_EXT.get(content_type, ".bin")
+
+def blob_relpath(blob_key: str) -> str:
+    # Shard by the first two hex chars (git-style) so no directory grows unbounded
+    return f"{blob_key.removeprefix('b_')[:2]}/{blob_key}.wav"
+
+def blob_path(blob_key: str) -> Path:
+    # Derived from the key alone; audio_blobs.file_path is informational only
+    return Path(BLOB_DIR) / blob_relpath(blob_key)
 
 # -----------------------------
 # SQLite (simple, reliable)
 # -----------------------------
-_db_lock = asyncio.Lock()
+# Each connection is owned by one dedicated thread: a single writer thread
+# (which also serializes writes) and DB_READERS reader threads that each keep
+# their own query_only connection, so statement and page caches stay hot.
+_CONN: Optional[sqlite3.Connection] = None
+_DB_WRITER: Optional[ThreadPoolExecutor] = None
+_DB_READER: Optional[ThreadPoolExecutor] = None
+_reader_local = threading.local()
+_reader_conns: list[sqlite3.Connection] = []
+
+# Per-connection settings; journal_mode=WAL is persistent and set once in init_db.
+_PRAGMAS = (
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_spill=0",
+    "PRAGMA foreign_keys=ON",
+)
+
+def _open_connection(read_only: bool = False) -> sqlite3.Connection:
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    for pragma in _PRAGMAS:
+        conn.execute(pragma)
+    if read_only:
+        conn.execute("PRAGMA query_only=1")
+    return conn
 
 def _connect() -> sqlite3.Connection:
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
+    # Writer connection; only used from the db-write thread.
+    global _CONN
+    if _CONN is None:
+        _CONN = _open_connection()
+    return _CONN
+
+def _reader_connection() -> sqlite3.Connection:
+    # Called on a db-read thread; each thread opens its own connection once.
+    conn = getattr(_reader_local, "conn", None)
+    if conn is None:
+        conn = _reader_local.conn = _open_connection(read_only=True)
+        _reader_conns.append(conn)
     return conn
 
-def init_db() -> None:
+def _read(sql: str, params: tuple, one: bool):
+    # Closing the cursor ends the implicit read transaction.
+    cur = _reader_connection().execute(sql, params)
+    try:
+        return cur.fetchone() if one else cur.fetchall()
+    finally:
+        cur.close()
+
+def _write(sql: str, params: tuple) -> None:
+    _connect().execute(sql, params)
+
+def _write_many(sql: str, seq: list[tuple]) -> None:
+    # Autocommit would make every row its own transaction; commit them as one
     conn = _connect()
-    cur = conn.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS devices (
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.executemany(sql, seq)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+def _write_transaction(statements: list[tuple[str, tuple]]) -> list[int]:
+    # One BEGIN IMMEDIATE ... COMMIT (one WAL commit) for related writes
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        counts = [conn.execute(sql, params).rowcount for sql, params in statements]
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return counts
+
+def _write_returning(sql: str, params: tuple, one: bool):
+    # For INSERT/UPDATE ... RETURNING; closing the cursor finishes the statement.
+    cur = _connect().execute(sql, params)
+    try:
+        return cur.fetchone() if one else cur.fetchall()
+    finally:
+        cur.close()
+
+def _write_returning_each(sql: str, seq: list[tuple]) -> list[Optional[sqlite3.Row]]:
+    # executemany() can't hand back RETURNING rows; run the statements one by
+    # one inside a single transaction and keep each one's row (or None).
+    conn = _connect()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = []
+        for params in seq:
+            cur = conn.execute(sql, params)
+            rows.append(cur.fetchone())
+            cur.close()
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return rows
+
+DB_WRITE_ATTEMPTS = 3
+
+async def _on_writer(fn, *args):
+    global _DB_WRITER
+    if _DB_WRITER is None:
+        _DB_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+    loop = asyncio.get_running_loop()
+    # All our writes share one thread, so "locked" can only come from another
+    # process (e.g. a sqlite3 shell) outlasting busy_timeout. Each write is a
+    # single statement or a rolled-back transaction, so retrying is safe; back
+    # off on the event loop rather than holding the writer thread.
+    for attempt in range(DB_WRITE_ATTEMPTS):
+        try:
+            return await loop.run_in_executor(_DB_WRITER, fn, *args)
+        except sqlite3.OperationalError as e:
+            if attempt + 1 == DB_WRITE_ATTEMPTS or "database is locked" not in str(e):
+                raise
+            await asyncio.sleep(0.1 * 2 ** attempt)
+
+async def _on_reader(fn, *args):
+    global _DB_READER
+    if _DB_READER is None:
+        _DB_READER = ThreadPoolExecutor(max_workers=max(1, DB_READERS), thread_name_prefix="db-read")
+    return await asyncio.get_running_loop().run_in_executor(_DB_READER, fn, *args)
+
+def close_db() -> None:
+    global _CONN, _DB_WRITER, _DB_READER
+    for executor in (_DB_WRITER, _DB_READER):
+        if executor is not None:
+            executor.shutdown(wait=True)
+    _DB_WRITER = _DB_READER = None
+    while _reader_conns:
+        _reader_conns.pop().close()
+    if _CONN is not None:
+        _CONN.close()
+        _CONN = None
+
+# Timestamps are stored as INTEGER milliseconds since the epoch (UTC) and only
+# turned into ISO strings at the API boundary.
+_TABLES = {
+    "devices": """
         device_id TEXT PRIMARY KEY,
         name TEXT NOT NULL,
         device_token TEXT NOT NULL,
-        paired_at TEXT NOT NULL,
-        last_seen_at TEXT
-    )
-    """)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS pairing_codes (
+        paired_at INTEGER NOT NULL,
+        last_seen_at INTEGER
+    """,
+    "pairing_codes": """
         code TEXT PRIMARY KEY,
-        created_at TEXT NOT NULL,
-        expires_at TEXT NOT NULL,
-        used_at TEXT,
+        created_at INTEGER NOT NULL,
+        expires_at INTEGER NOT NULL,
+        used_at INTEGER,
         claimed_device_id TEXT
-    )
-    """)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS messages (
+    """,
+    "messages": """
         message_id TEXT PRIMARY KEY,
         device_id TEXT NOT NULL,
         type TEXT NOT NULL,
         text TEXT,
         audio_blob_key TEXT,
         priority TEXT NOT NULL,
-        created_at TEXT NOT NULL,
-        expires_at TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
+        expires_at INTEGER NOT NULL,
         state TEXT NOT NULL,
         details TEXT,
-        FOREIGN KEY(device_id) REFERENCES devices(device_id)
-    )
-    """)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS audio_blobs (
+        audio_url TEXT,
+        FOREIGN KEY(device_id) REFERENCES devices(device_id),
+        FOREIGN KEY(audio_blob_key) REFERENCES audio_blobs(blob_key)
+    """,
+    "audio_blobs": """
         blob_key TEXT PRIMARY KEY,
         content_type TEXT NOT NULL,
         size_bytes INTEGER NOT NULL,
         file_path TEXT NOT NULL,
-        created_at TEXT NOT NULL
+        created_at INTEGER NOT NULL
+    """,
+}
+_TIMESTAMP_COLUMNS = {
+    "devices": ("paired_at", "last_seen_at"),
+    "pairing_codes": ("created_at", "expires_at", "used_at"),
+    "messages": ("created_at", "expires_at"),
+    "audio_blobs": ("created_at",),
+}
+# v1: epoch-ms timestamps. v2: messages.audio_blob_key is a foreign key.
+# v3: messages.audio_url, the signed URL rendered once at enqueue.
+SCHEMA_VERSION = 3
+
+def _rebuild_tables(conn: sqlite3.Connection, tables, convert=None) -> None:
+    """Recreate tables from their current _TABLES definition, copying rows across.
+
+    The result is always the latest schema, so a rebuild sets SCHEMA_VERSION.
+    convert(table, column) may return an SQL expression to copy a column through.
+    """
+    # Dropping a parent table with foreign_keys=ON would try to cascade into its
+    # children; the pragma is a no-op inside a transaction, so flip it out here.
+    conn.execute("PRAGMA foreign_keys=OFF")
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for table in tables:
+            cols = [r["name"] for r in conn.execute(f"PRAGMA table_info({table})")]
+            select = ", ".join((convert and convert(table, c)) or c for c in cols)
+            conn.execute(f"CREATE TABLE {table}_new ({_TABLES[table]})")
+            conn.execute(f"INSERT INTO {table}_new({', '.join(cols)}) SELECT {select} FROM {table}")
+            conn.execute(f"DROP TABLE {table}")
+            conn.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+        _backfill_audio_urls(conn)
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.execute("PRAGMA foreign_keys=ON")
+
+def _migrate_iso_timestamps(conn: sqlite3.Connection) -> None:
+    """Rebuild the pre-v1 tables, converting ISO-8601 TEXT timestamps to epoch ms."""
+    conn.create_function("iso_to_ms", 1, lambda v: v if v is None or isinstance(v, int) else dt_to_ms(iso_to_dt(v)), deterministic=True)
+    _rebuild_tables(conn, _TABLES, lambda table, c: f"iso_to_ms({c})" if c in _TIMESTAMP_COLUMNS[table] else None)
+
+def _shard_flat_blobs(conn: sqlite3.Connection) -> None:
+    """Move blobs from the old flat BLOB_DIR layout into their shard directories."""
+    for old in Path(BLOB_DIR).glob("b_*.wav"):
+        new = blob_path(old.stem)
+        new.parent.mkdir(exist_ok=True)
+        os.replace(old, new)
+        conn.execute("UPDATE audio_blobs SET file_path = ? WHERE blob_key = ?", (blob_relpath(old.stem), old.stem))
+
+def _backfill_audio_urls(conn: sqlite3.Connection) -> None:
+    """Render audio_url for audio messages queued before the column existed."""
+    conn.create_function("build_audio_url", 3, build_audio_url, deterministic=True)
+    conn.execute(
+        "UPDATE messages SET audio_url = build_audio_url(device_id, audio_blob_key, expires_at) "
+        "WHERE state = 'queued' AND type = 'audio' AND audio_blob_key IS NOT NULL"
     )
-    """)
-    conn.commit()
-    conn.close()
+
+def _add_audio_url_column(conn: sqlite3.Connection) -> None:
+    """v2 -> v3 in one transaction, so an interrupted start simply reruns it."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("ALTER TABLE messages ADD COLUMN audio_url TEXT")
+        _backfill_audio_urls(conn)
+        conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+def init_db() -> None:
+    conn = _connect()
+    cur = conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    version = cur.execute("PRAGMA user_version").fetchone()[0]
+    has_tables = cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'devices'").fetchone()
+    if has_tables and version < 1:
+        _migrate_iso_timestamps(conn)
+    elif has_tables and version < 2:
+        _rebuild_tables(conn, ("messages",))
+    elif has_tables and version < 3:
+        _add_audio_url_column(conn)
+    for table, columns in _TABLES.items():
+        cur.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns})")
+    cur.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+    cur.execute("DROP INDEX IF EXISTS idx_messages_dev_state_exp")
+    cur.execute("DROP INDEX IF EXISTS idx_messages_device_state_created")
+    # Only queued rows, in claim order: stays small however much history piles up
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_queued ON messages(device_id, priority DESC, created_at) "
+        "WHERE state = 'queued'"
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_state_expires ON messages(state, expires_at)")
+    _shard_flat_blobs(conn)
+    _TOKEN_CACHE.clear()
+    for row in cur.execute("SELECT device_id, device_token, name FROM devices"):
+        _TOKEN_CACHE[row["device_id"]] = (row["device_token"], row["name"])
+    cur.close()
 
 async def db_exec(sql: str, params: tuple = ()) -> None:
-    async with _db_lock:
-        def _run():
-            conn = _connect()
-            conn.execute(sql, params)
-            conn.commit()
-            conn.close()
-        await asyncio.to_thread(_run)
+    await _on_writer(_write, sql, params)
+
+async def db_executemany(sql: str, seq: list[tuple]) -> None:
+    await _on_writer(_write_many, sql, seq)
+
+async def db_transaction(statements: list[tuple[str, tuple]]) -> list[int]:
+    """Run the statements atomically on the writer; returns each one's rowcount."""
+    return await _on_writer(_write_transaction, statements)
+
+async def db_exec_fetchone(sql: str, params: tuple = ()) -> Optional[sqlite3.Row]:
+    return await _on_writer(_write_returning, sql, params, True)
+
+async def db_exec_fetchall(sql: str, params: tuple = ()) -> list[sqlite3.Row]:
+    return await _on_writer(_write_returning, sql, params, False)
+
+async def db_exec_fetchone_each(sql: str, seq: list[tuple]) -> list[Optional[sqlite3.Row]]:
+    return await _on_writer(_write_returning_each, sql, seq)
 
 async def db_fetchone(sql: str, params: tuple = ()) -> Optional[sqlite3.Row]:
-    async with _db_lock:
-        def _run():
-            conn = _connect()
-            cur = conn.execute(sql, params)
-            row = cur.fetchone()
-            conn.close()
-            return row
-        return await asyncio.to_thread(_run)
+    return await _on_reader(_read, sql, params, True)
 
 async def db_fetchall(sql: str, params: tuple = ()) -> list[sqlite3.Row]:
-    async with _db_lock:
-        def _run():
-            conn = _connect()
-            cur = conn.execute(sql, params)
-            rows = cur.fetchall()
-            conn.close()
-            return rows
-        return await asyncio.to_thread(_run)
+    return await _on_reader(_read, sql, params, False)
 
 # -----------------------------
 # In-memory notifiers for long-poll
 # -----------------------------
-_device_conditions: Dict[str, asyncio.Condition] = {}
-_conditions_lock = asyncio.Lock()
-
-async def _get_condition(device_id: str) -> asyncio.Condition:
-    async with _conditions_lock:
-        cond = _device_conditions.get(device_id)
-        if cond is None:
-            cond = asyncio.Condition()
-            _device_conditions[device_id] = cond
-        return cond
-
-async def notify_device(device_id: str) -> None:
-    cond = await _get_condition(device_id)
-    async with cond:
-        cond.notify_all()
+# One future per waiting poll, oldest first. An enqueue wakes exactly one of
+# them, so several polls on the same device don't all race for one message.
+_device_waiters: Dict[str, deque] = {}
+
+def _add_waiter(device_id: str) -> asyncio.Future:
+    fut = asyncio.get_running_loop().create_future()
+    _device_waiters.setdefault(device_id, deque()).append(fut)
+    return fut
+
+def _drop_waiter(device_id: str, fut: asyncio.Future) -> None:
+    if fut.done():
+        # Woken but leaving anyway: the wakeup may be for a message this poll
+        # didn't take, so pass it on rather than strand it until a timeout.
+        notify_device(device_id)
+        return
+    q = _device_waiters.get(device_id)
+    if q is not None:
+        q.remove(fut)
+        if not q:
+            del _device_waiters[device_id]
+
+def notify_device(device_id: str) -> None:
+    q = _device_waiters.get(device_id)
+    while q:
+        fut = q.popleft()
+        if not fut.done():
+            fut.set_result(None)
+            break
+    if q is not None and not q:
+        del _device_waiters[device_id]
+
+# -----------------------------
+# Coalesced last-seen updates
+# -----------------------------
+LAST_SEEN_FLUSH_SECONDS = float(os.getenv("LAST_SEEN_FLUSH_SECONDS", "2"))
+_last_seen: Dict[str, int] = {}
+_UPDATE_LAST_SEEN_SQL = "UPDATE devices SET last_seen_at = ? WHERE device_id = ?"
+
+async def flush_last_seen() -> None:
+    global _last_seen
+    if not _last_seen:
+        return
+    pending, _last_seen = _last_seen, {}
+    await db_executemany(
+        _UPDATE_LAST_SEEN_SQL,
+        [(seen, device_id) for device_id, seen in pending.items()]
+    )
+
+async def _flush_last_seen() -> None:
+    while True:
+        await asyncio.sleep(LAST_SEEN_FLUSH_SECONDS)
+        try:
+            await flush_last_seen()
+        except sqlite3.Error:
+            pass  # best-effort; next round retries with fresh values
+        except Exception:
+            log.exception("last-seen flush failed")
+
+# -----------------------------
+# Periodic expiry sweep
+# -----------------------------
+EXPIRE_SWEEP_SECONDS = 10.0
+
+async def _expire_messages() -> None:
+    while True:
+        await asyncio.sleep(EXPIRE_SWEEP_SECONDS)
+        try:
+            drop_stale_uploads()
+            await expire_queued_messages()
+        except sqlite3.Error:
+            pass
+        except Exception:
+            log.exception("expiry sweep failed")
 
 # -----------------------------
 # Auth dependencies
 # -----------------------------
 def _bearer_token(req: Request) -> str:
     auth = req.headers.get("authorization", "")
-    if not auth.lower().startswith("bearer "):
+    if len(auth) < 7 or auth[:7].lower() != "bearer ":
         return ""
-    return auth.split(" ", 1)[1].strip()
+    return auth[7:].strip()
 
 async def require_admin(req: Request) -> None:
     token = _bearer_token(req)
     if not token or token != ADMIN_TOKEN:
         raise HTTPException(status_code=401, detail="Unauthorized (admin)")
 
+# device_id -> (device_token, name); tokens never change once a device is paired,
+# so entries are only ever added (at startup, on pairing or on a cache miss).
+_TOKEN_CACHE: Dict[str, tuple[str, str]] = {}
+
 class DeviceContext(BaseModel):
     device_id: str
     name: str
@@ -261,12 +638,18 @@ async def require_device(req: Request, device_id: str) -> DeviceContext:
     token = _bearer_token(req)
     if not token:
         raise HTTPException(status_code=401, detail="Unauthorized (device)")
-    row = await db_fetchone("SELECT device_id, name, device_token FROM devices WHERE device_id = ?", (device_id,))
-    if not row or row["device_token"] != token:
+    cached = _TOKEN_CACHE.get(device_id)
+    if cached is None:
+        row = await db_fetchone("SELECT device_token, name FROM devices WHERE device_id = ?", (device_id,))
+        if not row:
+            raise HTTPException(status_code=401, detail="Unauthorized (device)")
+        cached = _TOKEN_CACHE[device_id] = (row["device_token"], row["name"])
+    device_token, name = cached
+    if not hmac.compare_digest(device_token.encode(), token.encode()):
         raise HTTPException(status_code=401, detail="Unauthorized (device)")
-    # Update last seen (best-effort)
-    await db_exec("UPDATE devices SET last_seen_at = ? WHERE device_id = ?", (dt_to_iso(utcnow()), device_id))
-    return DeviceContext(device_id=row["device_id"], name=row["name"])
+    # Update last seen (best-effort, flushed in batches by _flush_last_seen)
+    _last_seen[device_id] = now_ms()
+    return DeviceContext(device_id=device_id, name=name)
 
 async def require_device_or_admin(req: Request, device_id: str) -> None:
     """Allow either:
@@ -320,6 +703,9 @@ class NextMessageResponse(BaseModel):
     createdAt: str
     expiresAt: str
 
+class NextMessagesResponse(BaseModel):
+    messages: list[NextMessageResponse]
+
 class AckRequest(BaseModel):
     status: AckStatus
     details: Optional[str] = None
@@ -330,14 +716,46 @@ class UploadAudioResponse(BaseModel):
     contentType: str
     sizeBytes: int
 
+class ChunkedUploadInitRequest(BaseModel):
+    filename: Optional[str] = None
+    contentType: Optional[str] = None
+
+class ChunkedUploadInitResponse(BaseModel):
+    uploadId: str
+    chunkSizeBytes: int
+
+class ChunkedUploadCompleteRequest(BaseModel):
+    chunks: int = Field(..., ge=1, le=MAX_UPLOAD_CHUNKS)
+
 # -----------------------------
 # App
 # -----------------------------
-app = FastAPI(title="Headphone Pager", version="1.0")
+app = FastAPI(title="Headphone Pager", version="1.0", default_response_class=ORJSONResponse)
+
+_background_tasks: list[asyncio.Task] = []
 
 @app.on_event("startup")
 async def _startup():
-    init_db()
+    global _ack_queue
+    await _on_writer(init_db)
+    # Chunked uploads are tracked in memory, so leftovers from a previous run are orphans
+    shutil.rmtree(PENDING_UPLOAD_DIR, ignore_errors=True)
+    _background_tasks.append(asyncio.create_task(_flush_last_seen()))
+    _background_tasks.append(asyncio.create_task(_expire_messages()))
+    _ack_queue = asyncio.Queue()
+    _background_tasks.append(asyncio.create_task(_write_acks()))
+
+@app.on_event("shutdown")
+async def _shutdown():
+    for task in _background_tasks:
+        task.cancel()
+    _background_tasks.clear()
+    # Don't lose the last few seconds of last-seen updates on restart
+    try:
+        await flush_last_seen()
+    except sqlite3.Error:
+        pass
+    close_db()
 
 # -----------------------------
 # UI (simple single page)
@@ -349,454 +767,7 @@ _UI_HTML = r"""
   <meta charset="utf-8"/>
   <meta name="viewport" content="width=device-width, initial-scale=1"/>
   <title>Headphone Pager</title>
-  <style>
-    :root {
-      --primary: #3b82f6;
-      --primary-dark: #2563eb;
-      --success: #10b981;
-      --danger: #ef4444;
-      --warning: #f59e0b;
-      --gray-50: #f9fafb;
-      --gray-100: #f3f4f6;
-      --gray-200: #e5e7eb;
-      --gray-300: #d1d5db;
-      --gray-600: #4b5563;
-      --gray-700: #374151;
-      --gray-800: #1f2937;
-      --gray-900: #111827;
-      --border-radius: 12px;
-      --shadow-sm: 0 1px 2px 0 rgb(0 0 0 / 0.05);
-      --shadow: 0 1px 3px 0 rgb(0 0 0 / 0.1), 0 1px 2px -1px rgb(0 0 0 / 0.1);
-      --shadow-lg: 0 10px 15px -3px rgb(0 0 0 / 0.1), 0 4px 6px -4px rgb(0 0 0 / 0.1);
-    }
-    
-    * {
-      box-sizing: border-box;
-      margin: 0;
-      padding: 0;
-    }
-    
-    body {
-      font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, 'Helvetica Neue', Arial, sans-serif;
-      background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-      min-height: 100vh;
-      padding: 16px;
-      color: var(--gray-900);
-    }
-    
-    .container {
-      max-width: 800px;
-      margin: 0 auto;
-    }
-    
-    .header {
-      background: white;
-      border-radius: var(--border-radius);
-      padding: 24px;
-      margin-bottom: 20px;
-      box-shadow: var(--shadow-lg);
-      text-align: center;
-    }
-    
-    .header h1 {
-      font-size: 28px;
-      color: var(--gray-900);
-      margin-bottom: 8px;
-      font-weight: 700;
-    }
-    
-    .header p {
-      color: var(--gray-600);
-      font-size: 14px;
-    }
-    
-    .card {
-      background: white;
-      border-radius: var(--border-radius);
-      padding: 24px;
-      margin-bottom: 20px;
-      box-shadow: var(--shadow-lg);
-    }
-    
-    .card-header {
-      display: flex;
-      align-items: center;
-      gap: 12px;
-      margin-bottom: 20px;
-      padding-bottom: 16px;
-      border-bottom: 2px solid var(--gray-100);
-    }
-    
-    .card-number {
-      background: var(--primary);
-      color: white;
-      width: 32px;
-      height: 32px;
-      border-radius: 50%;
-      display: flex;
-      align-items: center;
-      justify-content: center;
-      font-weight: 700;
-      font-size: 16px;
-      flex-shrink: 0;
-    }
-    
-    .card-header h2 {
-      font-size: 20px;
-      color: var(--gray-800);
-      font-weight: 600;
-      flex: 1;
-    }
-    
-    .form-group {
-      margin-bottom: 16px;
-    }
-    
-    .form-group:last-child {
-      margin-bottom: 0;
-    }
-    
-    label {
-      display: block;
-      font-size: 14px;
-      font-weight: 500;
-      color: var(--gray-700);
-      margin-bottom: 6px;
-    }
-    
-    input, select, textarea {
-      width: 100%;
-      padding: 12px 16px;
-      font-size: 15px;
-      border: 2px solid var(--gray-200);
-      border-radius: 8px;
-      background: white;
-      color: var(--gray-900);
-      transition: all 0.2s;
-      font-family: inherit;
-    }
-    
-    input:focus, select:focus, textarea:focus {
-      outline: none;
-      border-color: var(--primary);
-      box-shadow: 0 0 0 3px rgba(59, 130, 246, 0.1);
-    }
-    
-    input[type="file"] {
-      padding: 10px;
-      font-size: 14px;
-    }
-    
-    textarea {
-      min-height: 100px;
-      resize: vertical;
-    }
-    
-    button {
-      background: var(--primary);
-      color: white;
-      border: none;
-      padding: 12px 24px;
-      font-size: 15px;
-      font-weight: 500;
-      border-radius: 8px;
-      cursor: pointer;
-      transition: all 0.2s;
-      font-family: inherit;
-      display: inline-flex;
-      align-items: center;
-      justify-content: center;
-      gap: 8px;
-      white-space: nowrap;
-    }
-    
-    button:hover:not(:disabled) {
-      background: var(--primary-dark);
-      transform: translateY(-1px);
-      box-shadow: var(--shadow);
-    }
-    
-    button:active:not(:disabled) {
-      transform: translateY(0);
-    }
-    
-    button:disabled {
-      opacity: 0.5;
-      cursor: not-allowed;
-    }
-    
-    button.secondary {
-      background: var(--gray-100);
-      color: var(--gray-700);
-    }
-    
-    button.secondary:hover:not(:disabled) {
-      background: var(--gray-200);
-    }
-    
-    button.success {
-      background: var(--success);
-    }
-    
-    button.success:hover:not(:disabled) {
-      background: #059669;
-    }
-    
-    button.danger {
-      background: var(--danger);
-    }
-    
-    button.danger:hover:not(:disabled) {
-      background: #dc2626;
-    }
-    
-    .button-group {
-      display: flex;
-      gap: 12px;
-      flex-wrap: wrap;
-    }
-    
-    .button-group button {
-      flex: 1;
-      min-width: 120px;
-    }
-    
-    .row {
-      display: grid;
-      gap: 12px;
-      grid-template-columns: 1fr;
-    }
-    
-    @media (min-width: 640px) {
-      .row.cols-2 {
-        grid-template-columns: 1fr 1fr;
-      }
-      
-      .row.cols-3 {
-        grid-template-columns: 1fr 1fr 1fr;
-      }
-      
-      .row.auto-fit {
-        grid-template-columns: repeat(auto-fit, minmax(140px, 1fr));
-      }
-    }
-    
-    .info-box {
-      background: var(--gray-50);
-      border: 1px solid var(--gray-200);
-      border-radius: 8px;
-      padding: 12px 16px;
-      font-size: 14px;
-      color: var(--gray-700);
-      line-height: 1.6;
-    }
-    
-    .info-box code {
-      background: white;
-      padding: 2px 6px;
-      border-radius: 4px;
-      font-size: 13px;
-      color: var(--primary);
-      font-family: 'Monaco', 'Courier New', monospace;
-    }
-    
-    .status-message {
-      padding: 12px 16px;
-      border-radius: 8px;
-      font-size: 14px;
-      margin-top: 12px;
-      display: none;
-    }
-    
-    .status-message.show {
-      display: block;
-    }
-    
-    .status-message.success {
-      background: #d1fae5;
-      color: #065f46;
-      border: 1px solid #6ee7b7;
-    }
-    
-    .status-message.error {
-      background: #fee2e2;
-      color: #991b1b;
-      border: 1px solid #fca5a5;
-    }
-    
-    .status-message.info {
-      background: #dbeafe;
-      color: #1e40af;
-      border: 1px solid #93c5fd;
-    }
-    
-    .pill {
-      display: inline-block;
-      padding: 6px 14px;
-      border-radius: 999px;
-      background: var(--gray-100);
-      color: var(--gray-700);
-      font-size: 13px;
-      font-weight: 500;
-      border: 1px solid var(--gray-200);
-    }
-    
-    .pill.recording {
-      background: #fee2e2;
-      color: #991b1b;
-      border-color: #fca5a5;
-      animation: pulse 2s ease-in-out infinite;
-    }
-    
-    .pill.ready {
-      background: #d1fae5;
-      color: #065f46;
-      border-color: #6ee7b7;
-    }
-    
-    @keyframes pulse {
-      0%, 100% { opacity: 1; }
-      50% { opacity: 0.7; }
-    }
-    
-    audio {
-      width: 100%;
-      margin-top: 12px;
-      border-radius: 8px;
-    }
-    
-    .device-info {
-      background: var(--gray-50);
-      border: 1px solid var(--gray-200);
-      border-radius: 8px;
-      padding: 12px 16px;
-      font-size: 14px;
-      color: var(--gray-700);
-      margin-top: 12px;
-    }
-    
-    .device-info strong {
-      color: var(--gray-900);
-      font-weight: 600;
-    }
-    
-    .pairing-code {
-      background: linear-gradient(135deg, var(--primary) 0%, var(--primary-dark) 100%);
-      color: white;
-      padding: 20px;
-      border-radius: 8px;
-      text-align: center;
-      margin-top: 16px;
-      box-shadow: var(--shadow);
-    }
-    
-    .pairing-code-number {
-      font-size: 36px;
-      font-weight: 700;
-      letter-spacing: 4px;
-      margin: 8px 0;
-      font-family: 'Monaco', 'Courier New', monospace;
-    }
-    
-    .pairing-code-label {
-      font-size: 12px;
-      opacity: 0.9;
-      text-transform: uppercase;
-      letter-spacing: 1px;
-    }
-    
-    .pairing-code-expires {
-      font-size: 13px;
-      opacity: 0.8;
-      margin-top: 8px;
-    }
-    
-    .section-divider {
-      border: none;
-      border-top: 2px solid var(--gray-100);
-      margin: 24px 0;
-    }
-    
-    .section-title {
-      font-size: 16px;
-      font-weight: 600;
-      color: var(--gray-800);
-      margin-bottom: 16px;
-      display: flex;
-      align-items: center;
-      gap: 8px;
-    }
-    
-    .section-title::before {
-      content: '';
-      width: 4px;
-      height: 20px;
-      background: var(--primary);
-      border-radius: 2px;
-    }
-    
-    .hidden {
-      display: none !important;
-    }
-    
-    /* Loading spinner */
-    .spinner {
-      border: 3px solid var(--gray-200);
-      border-top: 3px solid var(--primary);
-      border-radius: 50%;
-      width: 20px;
-      height: 20px;
-      animation: spin 1s linear infinite;
-      display: inline-block;
-    }
-    
-    @keyframes spin {
-      0% { transform: rotate(0deg); }
-      100% { transform: rotate(360deg); }
-    }
-    
-    /* Mobile optimizations */
-    @media (max-width: 639px) {
-      body {
-        padding: 12px;
-      }
-      
-      .header {
-        padding: 20px 16px;
-      }
-      
-      .header h1 {
-        font-size: 24px;
-      }
-      
-      .card {
-        padding: 20px 16px;
-      }
-      
-      .card-header h2 {
-        font-size: 18px;
-      }
-      
-      .pairing-code-number {
-        font-size: 28px;
-        letter-spacing: 2px;
-      }
-      
-      button {
-        padding: 12px 16px;
-        font-size: 14px;
-      }
-    }
-    
-    /* Accessibility improvements */
-    @media (prefers-reduced-motion: reduce) {
-      *, *::before, *::after {
-        animation-duration: 0.01ms !important;
-        animation-iteration-count: 1 !important;
-        transition-duration: 0.01ms !important;
-      }
-    }
-  </style>
+  <link rel="stylesheet" href="/static/app.css?v=__APP_CSS_VERSION__"/>
 </head>
 <body>
   <div class="container">
@@ -1111,22 +1082,76 @@ _UI_HTML = r"""
     }
 
     // Audio Upload
+    // Large blobs (long WAV recordings) go up in chunks, a few in parallel,
+    // and a failed chunk is retried on its own instead of the whole file.
+    const CHUNKED_UPLOAD_MIN_BYTES = 4 * 1024 * 1024;
+    const CHUNK_UPLOAD_CONCURRENCY = 4;
+    const CHUNK_UPLOAD_ATTEMPTS = 3;
+
+    async function uploadChunked(file, status) {
+      const auth = { "Authorization": "Bearer " + getToken() };
+      const json = Object.assign({ "Content-Type": "application/json" }, auth);
+      
+      const init = await fetch("/api/uploads/audio/chunked/init", {
+        method: "POST",
+        headers: json,
+        body: JSON.stringify({ filename: file.name, contentType: file.type })
+      });
+      if (!init.ok) return init;
+      
+      const { uploadId, chunkSizeBytes } = await init.json();
+      const base = "/api/uploads/audio/chunked/" + encodeURIComponent(uploadId);
+      const count = Math.ceil(file.size / chunkSizeBytes);
+      let next = 0;
+      let done = 0;
+      
+      async function worker() {
+        while (next < count) {
+          const idx = next++;
+          const body = file.slice(idx * chunkSizeBytes, (idx + 1) * chunkSizeBytes);
+          for (let attempt = 1; ; attempt++) {
+            const r = await fetch(base + "/" + idx, { method: "PUT", headers: auth, body }).catch(() => null);
+            if (r && r.ok) break;
+            if (attempt >= CHUNK_UPLOAD_ATTEMPTS) {
+              throw new Error(`chunk ${idx} failed` + (r ? ` (${r.status})` : ""));
+            }
+          }
+          showStatus(status, `Uploading audio... ${Math.round(++done * 100 / count)}%`, "info");
+        }
+      }
+      
+      const workers = [];
+      for (let i = 0; i < Math.min(CHUNK_UPLOAD_CONCURRENCY, count); i++) workers.push(worker());
+      await Promise.all(workers);
+      
+      return fetch(base + "/complete", {
+        method: "POST",
+        headers: json,
+        body: JSON.stringify({ chunks: count })
+      });
+    }
+
     async function uploadBlobAsAudioAndSend(deviceId, blob, filenameHint) {
       const status = document.getElementById("sendStatus");
       
-      const fd = new FormData();
       const file = new File([blob], filenameHint || "recording.webm", { 
         type: blob.type || "audio/webm" 
       });
-      fd.append("file", file);
       
       showStatus(status, "Uploading audio...", "info");
       
-      const up = await fetch("/api/uploads/audio", {
-        method: "POST",
-        headers: { "Authorization": "Bearer " + getToken() },
-        body: fd
-      });
+      let up;
+      if (file.size >= CHUNKED_UPLOAD_MIN_BYTES) {
+        up = await uploadChunked(file, status);
+      } else {
+        const fd = new FormData();
+        fd.append("file", file);
+        up = await fetch("/api/uploads/audio", {
+          method: "POST",
+          headers: { "Authorization": "Bearer " + getToken() },
+          body: fd
+        });
+      }
       
       if (!up.ok) {
         showStatus(status, "Upload failed: " + up.status, "error");
@@ -1185,7 +1210,13 @@ _UI_HTML = r"""
     }
 
     // Recording
+    // Preferred path: capture PCM with an AudioWorklet and build a 16 kHz mono
+    // 16-bit WAV here (~32 KB/s, plenty for voice). The server upmixes it to
+    // its 48 kHz stereo storage format. Browsers without AudioWorklet (or that
+    // refuse a 16 kHz context) fall back to MediaRecorder.
+    const PCM_SAMPLE_RATE = 16000;
     let mediaRecorder = null;
+    let pcmRecorder = null;
     let recordedChunks = [];
     let recordedBlob = null;
 
@@ -1211,11 +1242,75 @@ _UI_HTML = r"""
       return "";
     }
 
+    async function startPcmRecorder(stream) {
+      const ctx = new AudioContext({ sampleRate: PCM_SAMPLE_RATE });
+      try {
+        // Created after the getUserMedia await, so it may start suspended
+        await ctx.resume();
+        await ctx.audioWorklet.addModule("/static/pcm-recorder.js?v=__PCM_RECORDER_VERSION__");
+        const source = ctx.createMediaStreamSource(stream);
+        const node = new AudioWorkletNode(ctx, "pcm-recorder");
+        const chunks = [];
+        let finish;
+        const done = new Promise(resolve => { finish = resolve; });
+        node.port.onmessage = (e) => {
+          if (e.data.samples.length) chunks.push(e.data.samples);
+          if (e.data.done) finish(chunks);
+        };
+        source.connect(node);
+        node.connect(ctx.destination);  // keeps the node pulled; it outputs silence
+        return { ctx, node, done };
+      } catch (err) {
+        ctx.close();
+        throw err;
+      }
+    }
+
+    function encodeWav(chunks, sampleRate) {
+      let frames = 0;
+      for (const c of chunks) frames += c.length;
+      const dataBytes = frames * 2;  // mono, 16-bit
+      const view = new DataView(new ArrayBuffer(44 + dataBytes));
+      const ascii = (off, s) => { for (let i = 0; i < s.length; i++) view.setUint8(off + i, s.charCodeAt(i)); };
+      ascii(0, "RIFF"); view.setUint32(4, 36 + dataBytes, true); ascii(8, "WAVE");
+      ascii(12, "fmt "); view.setUint32(16, 16, true);
+      view.setUint16(20, 1, true);               // PCM
+      view.setUint16(22, 1, true);               // channels
+      view.setUint32(24, sampleRate, true);
+      view.setUint32(28, sampleRate * 2, true);  // byte rate
+      view.setUint16(32, 2, true);               // block align
+      view.setUint16(34, 16, true);              // bits per sample
+      ascii(36, "data"); view.setUint32(40, dataBytes, true);
+      let off = 44;
+      for (const c of chunks) {
+        for (let i = 0; i < c.length; i++) {
+          const x = Math.max(-1, Math.min(1, c[i]));
+          const v = x < 0 ? x * 0x8000 : x * 0x7fff;
+          view.setInt16(off, v, true);
+          off += 2;
+        }
+      }
+      return new Blob([view.buffer], { type: "audio/wav" });
+    }
+
+    function onRecordingReady(blob) {
+      recordedBlob = blob;
+      const url = URL.createObjectURL(recordedBlob);
+      
+      const audio = document.getElementById("recPreview");
+      audio.src = url;
+      audio.classList.remove("hidden");
+      
+      document.getElementById("sendRecordedBtn").disabled = false;
+      setRecStatus(`Ready (${Math.round(recordedBlob.size / 1024)} KB)`, "ready");
+    }
+
     async function startRecording() {
       const status = document.getElementById("sendStatus");
       status.className = "status-message";
       
-      if (!navigator.mediaDevices || !navigator.mediaDevices.getUserMedia || !window.MediaRecorder) {
+      if (!navigator.mediaDevices || !navigator.mediaDevices.getUserMedia ||
+          !(window.AudioWorkletNode || window.MediaRecorder)) {
         showStatus(status, "Recording not supported in this browser", "error");
         return;
       }
@@ -1225,32 +1320,38 @@ _UI_HTML = r"""
       
       try {
         const stream = await navigator.mediaDevices.getUserMedia({ audio: true });
-        const mimeType = pickMimeType();
-        mediaRecorder = mimeType ? 
-          new MediaRecorder(stream, { mimeType }) : 
-          new MediaRecorder(stream);
         
-        mediaRecorder.ondataavailable = (e) => {
-          if (e.data && e.data.size > 0) recordedChunks.push(e.data);
-        };
+        pcmRecorder = null;
+        if (window.AudioWorkletNode) {
+          try {
+            pcmRecorder = await startPcmRecorder(stream);
+            pcmRecorder.stream = stream;
+          } catch (err) {
+            pcmRecorder = null;
+          }
+        }
         
-        mediaRecorder.onstop = () => {
-          stream.getTracks().forEach(t => t.stop());
+        if (!pcmRecorder) {
+          if (!window.MediaRecorder) throw new Error("no supported recorder");
+          const mimeType = pickMimeType();
+          mediaRecorder = mimeType ? 
+            new MediaRecorder(stream, { mimeType }) : 
+            new MediaRecorder(stream);
           
-          recordedBlob = new Blob(recordedChunks, { 
-            type: mediaRecorder.mimeType || "audio/webm" 
-          });
-          const url = URL.createObjectURL(recordedBlob);
+          mediaRecorder.ondataavailable = (e) => {
+            if (e.data && e.data.size > 0) recordedChunks.push(e.data);
+          };
           
-          const audio = document.getElementById("recPreview");
-          audio.src = url;
-          audio.classList.remove("hidden");
+          mediaRecorder.onstop = () => {
+            stream.getTracks().forEach(t => t.stop());
+            onRecordingReady(new Blob(recordedChunks, { 
+              type: mediaRecorder.mimeType || "audio/webm" 
+            }));
+          };
           
-          document.getElementById("sendRecordedBtn").disabled = false;
-          setRecStatus(`Ready (${Math.round(recordedBlob.size / 1024)} KB)`, "ready");
-        };
+          mediaRecorder.start();
+        }
         
-        mediaRecorder.start();
         document.getElementById("recStart").disabled = true;
         document.getElementById("recStop").disabled = false;
         document.getElementById("sendRecordedBtn").disabled = true;
@@ -1261,11 +1362,27 @@ _UI_HTML = r"""
       }
     }
 
-    function stopRecording() {
-      if (!mediaRecorder) return;
-      if (mediaRecorder.state === "recording") mediaRecorder.stop();
+    async function stopRecording() {
       document.getElementById("recStart").disabled = false;
       document.getElementById("recStop").disabled = true;
+      if (pcmRecorder) {
+        const rec = pcmRecorder;
+        pcmRecorder = null;
+        setRecStatus("Processing...");
+        rec.node.port.postMessage("stop");
+        const chunks = await rec.done;
+        rec.stream.getTracks().forEach(t => t.stop());
+        rec.ctx.close();
+        if (!chunks.length) {
+          setRecStatus("Ready to record");
+          showStatus(document.getElementById("sendStatus"), "Error: no audio was captured", "error");
+          return;
+        }
+        onRecordingReady(encodeWav(chunks, rec.ctx.sampleRate));
+        return;
+      }
+      if (!mediaRecorder) return;
+      if (mediaRecorder.state === "recording") mediaRecorder.stop();
       setRecStatus("Processing...");
     }
 
@@ -1282,7 +1399,8 @@ _UI_HTML = r"""
       document.getElementById("sendRecordedBtn").disabled = true;
       
       try {
-        const ext = (recordedBlob.type && recordedBlob.type.includes("ogg")) ? ".ogg" : ".webm";
+        const type = recordedBlob.type || "";
+        const ext = type.includes("wav") ? ".wav" : type.includes("ogg") ? ".ogg" : ".webm";
         const result = await uploadBlobAsAudioAndSend(deviceId, recordedBlob, "recording" + ext);
         
         if (!result) {
@@ -1320,51 +1438,119 @@ _UI_HTML = r"""
 
 """
 
+# Stylesheet and recorder worklet live in static/ and are cached forever; the
+# ?v= hash busts them on change.
+STATIC_DIR = Path(__file__).resolve().parent / "static"
+def _static_version(name: str) -> str:
+    return hashlib.blake2b((STATIC_DIR / name).read_bytes(), digest_size=6).hexdigest()
+
+_UI_HTML = (
+    _UI_HTML
+    .replace("__APP_CSS_VERSION__", _static_version("app.css"))
+    .replace("__PCM_RECORDER_VERSION__", _static_version("pcm-recorder.js"))
+)
+
+class _ImmutableStaticFiles(StaticFiles):
+    def file_response(self, *args, **kwargs) -> Response:
+        resp = super().file_response(*args, **kwargs)
+        resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return resp
+
+app.mount("/static", _ImmutableStaticFiles(directory=STATIC_DIR), name="static")
+
+# Encoded, compressed and hashed once at import; /ui only picks a variant.
+_UI_BODY = _UI_HTML.encode("utf-8")
+_UI_GZIP = gzip.compress(_UI_BODY, 9)
+_UI_ETAG = '"' + hashlib.blake2b(_UI_BODY, digest_size=8).hexdigest() + '"'
+# Each encoding is a different representation, so it gets its own validator
+_UI_ETAG_GZIP = _UI_ETAG[:-1] + '-gz"'
+
+def _accepts_gzip(accept_encoding: str) -> bool:
+    # Honour q-values: "gzip;q=0" is a refusal, and "*" covers gzip if unlisted
+    star = None
+    for part in accept_encoding.split(","):
+        coding, _, params = part.partition(";")
+        coding = coding.strip().lower()
+        if coding not in ("gzip", "*"):
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding == "gzip":
+            return q > 0
+        star = q
+    return bool(star and star > 0)
+
 @app.get("/ui", response_class=HTMLResponse)
-async def ui():
-    return HTMLResponse(_UI_HTML)
+async def ui(request: Request):
+    # no-cache = always revalidate; with the ETag that is a bodyless 304, and a
+    # redeploy shows up immediately instead of after some max-age.
+    use_gzip = _accepts_gzip(request.headers.get("accept-encoding", ""))
+    etag = _UI_ETAG_GZIP if use_gzip else _UI_ETAG
+    headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    if use_gzip:
+        headers["Content-Encoding"] = "gzip"
+        return Response(_UI_GZIP, media_type="text/html; charset=utf-8", headers=headers)
+    return Response(_UI_BODY, media_type="text/html; charset=utf-8", headers=headers)
 
 # -----------------------------
 # Pairing endpoints
 # -----------------------------
 @app.post("/api/pairing/start", response_model=PairStartResponse)
 async def pairing_start(_: None = Depends(require_admin)):
-    # Generate unique code (best-effort uniqueness)
+    # The PK enforces uniqueness; a stale (used or expired) row with the same
+    # code is recycled, a live one makes the upsert return nothing and we retry.
+    created = now_ms()
+    expires = created + PAIRING_CODE_TTL_SECONDS * 1000
     for _ in range(5):
         code = new_pairing_code()
-        existing = await db_fetchone("SELECT code FROM pairing_codes WHERE code = ? AND used_at IS NULL AND expires_at > ?", (code, dt_to_iso(utcnow())))
-        if not existing:
+        row = await db_exec_fetchone(
+            """INSERT INTO pairing_codes(code, created_at, expires_at, used_at, claimed_device_id) VALUES(?,?,?,NULL,NULL)
+               ON CONFLICT(code) DO UPDATE SET
+                   created_at = excluded.created_at, expires_at = excluded.expires_at, used_at = NULL, claimed_device_id = NULL
+               WHERE pairing_codes.used_at IS NOT NULL OR pairing_codes.expires_at <= excluded.created_at
+               RETURNING code""",
+            (code, created, expires)
+        )
+        if row:
             break
-    created = utcnow()
-    expires = created + timedelta(seconds=PAIRING_CODE_TTL_SECONDS)
-    await db_exec(
-        "INSERT OR REPLACE INTO pairing_codes(code, created_at, expires_at, used_at, claimed_device_id) VALUES(?,?,?,?,?)",
-        (code, dt_to_iso(created), dt_to_iso(expires), None, None)
-    )
-    return PairStartResponse(code=code, expiresAt=dt_to_iso(expires))
+    else:
+        raise HTTPException(status_code=503, detail="Could not allocate a pairing code, try again")
+    return PairStartResponse(code=code, expiresAt=ms_to_iso(expires))
 
 @app.post("/api/pairing/complete", response_model=PairCompleteResponse)
 async def pairing_complete(req: PairCompleteRequest):
+    now = now_ms()
     row = await db_fetchone("SELECT code, expires_at, used_at FROM pairing_codes WHERE code = ?", (req.code,))
     if not row:
         raise HTTPException(status_code=400, detail="Invalid pairing code")
     if row["used_at"]:
         raise HTTPException(status_code=400, detail="Pairing code already used")
-    if iso_to_dt(row["expires_at"]) <= utcnow():
+    if row["expires_at"] <= now:
         raise HTTPException(status_code=400, detail="Pairing code expired")
 
-    device_id = str(uuid.uuid4())
+    device_id = new_id()
     device_token = new_token()
-    now = utcnow()
 
-    await db_exec(
-        "INSERT INTO devices(device_id, name, device_token, paired_at, last_seen_at) VALUES(?,?,?,?,?)",
-        (device_id, req.deviceName, device_token, dt_to_iso(now), None)
-    )
-    await db_exec(
-        "UPDATE pairing_codes SET used_at = ?, claimed_device_id = ? WHERE code = ?",
-        (dt_to_iso(now), device_id, req.code)
-    )
+    # Claim the code and create the device in one transaction; the device row
+    # is only inserted if this request's UPDATE won the code.
+    claimed, _ = await db_transaction([
+        ("UPDATE pairing_codes SET used_at = ?, claimed_device_id = ? WHERE code = ? AND used_at IS NULL",
+         (now, device_id, req.code)),
+        ("""INSERT INTO devices(device_id, name, device_token, paired_at, last_seen_at)
+            SELECT ?, ?, ?, ?, NULL FROM pairing_codes WHERE code = ? AND claimed_device_id = ?""",
+         (device_id, req.deviceName, device_token, now, req.code, device_id)),
+    ])
+    if not claimed:
+        raise HTTPException(status_code=400, detail="Pairing code already used")
+    _TOKEN_CACHE[device_id] = (device_token, req.deviceName)
     return PairCompleteResponse(deviceId=device_id, deviceToken=device_token)
 
 # -----------------------------
@@ -1377,8 +1563,8 @@ async def list_devices():
         {
             "deviceId": r["device_id"],
             "name": r["name"],
-            "pairedAt": r["paired_at"],
-            "lastSeenAt": r["last_seen_at"],
+            "pairedAt": ms_to_iso(r["paired_at"]),
+            "lastSeenAt": (ms_to_iso(r["last_seen_at"]) if r["last_seen_at"] is not None else None),
         }
         for r in rows
     ]
@@ -1386,225 +1572,468 @@ async def list_devices():
 # -----------------------------
 # Upload audio (admin)
 # -----------------------------
-@app.post("/api/uploads/audio", response_model=UploadAudioResponse)
-async def upload_audio(file: UploadFile = File(...), _: None = Depends(require_admin)):
-    # Accept uploads even if content_type is missing or generic (some browsers send octet-stream)
-    data = await file.read()
-    if not data:
-        raise HTTPException(status_code=400, detail="Empty file")
-
+def _upload_ext(filename: Optional[str], content_type: Optional[str]) -> str:
     # Pick extension for ffmpeg probing
-    ext = Path(file.filename or "").suffix.lower()
+    ext = Path(filename or "").suffix.lower()
     if not ext:
         # fall back to content-type mapping if you have safe_ext; otherwise default
         try:
-            ext = safe_ext(getattr(file, "content_type", "") or "", file.filename or "") or ".bin"
+            ext = safe_ext(content_type or "", filename or "") or ".bin"
         except Exception:
             ext = ".bin"
+    return ext
 
-    wav_bytes = convert_to_wav_bytes(data, input_ext=ext)
-
+def _new_blob() -> tuple[str, Path]:
     # Store as .wav (client expects wav)
-    blob_key = "b_" + uuid.uuid4().hex
-    path = Path(BLOB_DIR) / f"{blob_key}.wav"
-    path.write_bytes(wav_bytes)
+    blob_key = "b_" + new_id()
+    path = blob_path(blob_key)
+    path.parent.mkdir(exist_ok=True)
+    return blob_key, path
+
+async def _register_blob(blob_key: str, path: Path) -> UploadAudioResponse:
+    size_bytes = path.stat().st_size
 
     await db_exec(
         "INSERT INTO audio_blobs(blob_key, content_type, size_bytes, file_path, created_at) VALUES(?,?,?,?,?)",
-        (blob_key, "audio/wav", len(wav_bytes), str(path), dt_to_iso(utcnow()))
+        (blob_key, "audio/wav", size_bytes, blob_relpath(blob_key), now_ms())
     )
 
-    return UploadAudioResponse(audioBlobKey=blob_key, contentType="audio/wav", sizeBytes=len(wav_bytes))
+    return UploadAudioResponse(audioBlobKey=blob_key, contentType="audio/wav", sizeBytes=size_bytes)
 
+async def _store_upload(tmp_path: str, tmp_size: int) -> UploadAudioResponse:
+    """Convert a spooled upload into a WAV blob and register it; always consumes tmp_path."""
+    blob_key, path = _new_blob()
+    try:
+        if not tmp_size:
+            raise HTTPException(status_code=400, detail="Empty file")
+        async with _FFMPEG_SEM:
+            await convert_file_to_wav(tmp_path, str(path))
+    finally:
+        Path(tmp_path).unlink(missing_ok=True)
+    return await _register_blob(blob_key, path)
 
-@app.get("/api/devices/{device_id}/audio/{blob_key}")
-async def get_audio(device_id: str, blob_key: str, req: Request):
-    await require_device_or_admin(req, device_id=device_id)
-    row = await db_fetchone("SELECT file_path, content_type FROM audio_blobs WHERE blob_key = ?", (blob_key,))
-    if not row:
-        raise HTTPException(status_code=404, detail="Not found")
-    fp = row["file_path"]
-    if not os.path.exists(fp):
-        raise HTTPException(status_code=404, detail="Missing blob file")
-    return FileResponse(fp, media_type=row["content_type"], filename=os.path.basename(fp))
+@app.post("/api/uploads/audio", response_model=UploadAudioResponse)
+async def upload_audio(file: UploadFile = File(...), _: None = Depends(require_admin)):
+    # Accept uploads even if content_type is missing or generic (some browsers send octet-stream)
+    head = await file.read(4096)
+    await file.seek(0)
+    if not head:
+        raise HTTPException(status_code=400, detail="Empty file")
+
+    # Common case (browser WebM/Ogg, MP3, other WAVs): pipe straight into ffmpeg
+    if not _is_target_wav(head) and not _needs_seekable_input(head):
+        blob_key, path = _new_blob()
+        async with _FFMPEG_SEM:
+            await convert_stream_to_wav(file, str(path))
+        return await _register_blob(blob_key, path)
+
+    # Target-format WAVs are just moved into place, and MP4-family files need a
+    # seekable input, so both go through a temp file.
+    ext = _upload_ext(file.filename, getattr(file, "content_type", ""))
+    # The multipart body is fully received by now; copy it to disk in chunks,
+    # on a worker thread so the disk writes never stall the event loop.
+    with tempfile.NamedTemporaryFile(dir=BLOB_DIR, suffix=ext, delete=False) as tmp:
+        await asyncio.to_thread(shutil.copyfileobj, file.file, tmp, UPLOAD_CHUNK_BYTES)
+        tmp_size = tmp.tell()
+
+    return await _store_upload(tmp.name, tmp_size)
 
 # -----------------------------
-# Messaging helpers
+# Chunked upload (admin)
 # -----------------------------
-async def expire_queued_messages(device_id: Optional[str] = None) -> None:
-    now_iso = dt_to_iso(utcnow())
-    if device_id:
-        await db_exec(
-            "UPDATE messages SET state = 'expired' WHERE state = 'queued' AND device_id = ? AND expires_at <= ?",
-            (device_id, now_iso)
-        )
+# Large recordings can be sent as numbered chunks (in parallel, each one
+# retryable) and stitched together on complete. Chunks live under
+# BLOB_DIR/pending/<upload_id>/<idx>.bin until then.
+
+# upload_id -> (extension, last touched ms)
+_pending_uploads: Dict[str, tuple[str, int]] = {}
+
+def _pending_dir(upload_id: str) -> Path:
+    if upload_id not in _pending_uploads:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return PENDING_UPLOAD_DIR / upload_id
+
+def _write_chunk(part: Path, dest: Path, data: bytearray) -> None:
+    with open(part, "wb") as f:
+        f.write(data)
+    os.replace(part, dest)
+
+def drop_stale_uploads() -> None:
+    cutoff = now_ms() - PENDING_UPLOAD_TTL_SECONDS * 1000
+    for upload_id, (_, touched) in list(_pending_uploads.items()):
+        if touched <= cutoff:
+            del _pending_uploads[upload_id]
+            shutil.rmtree(PENDING_UPLOAD_DIR / upload_id, ignore_errors=True)
+
+def _concat_chunks(src: Path, count: int, dest) -> int:
+    for idx in range(count):
+        with open(src / f"{idx}.bin", "rb") as f:
+            shutil.copyfileobj(f, dest, UPLOAD_CHUNK_BYTES)
+    return dest.tell()
+
+@app.post("/api/uploads/audio/chunked/init", response_model=ChunkedUploadInitResponse)
+async def chunked_upload_init(req: ChunkedUploadInitRequest, _: None = Depends(require_admin)):
+    upload_id = new_id()
+    (PENDING_UPLOAD_DIR / upload_id).mkdir(parents=True)
+    _pending_uploads[upload_id] = (_upload_ext(req.filename, req.contentType), now_ms())
+    return ChunkedUploadInitResponse(uploadId=upload_id, chunkSizeBytes=UPLOAD_CHUNK_BYTES)
+
+@app.put("/api/uploads/audio/chunked/{upload_id}/{idx}")
+async def chunked_upload_put(upload_id: str, idx: int, request: Request, _: None = Depends(require_admin)):
+    if idx < 0 or idx >= MAX_UPLOAD_CHUNKS:
+        raise HTTPException(status_code=400, detail="Chunk index out of range")
+    d = _pending_dir(upload_id)
+    if int(request.headers.get("content-length") or 0) > UPLOAD_CHUNK_BYTES:
+        raise HTTPException(status_code=413, detail="Chunk larger than chunkSizeBytes")
+    # Chunks are capped at UPLOAD_CHUNK_BYTES, so buffer in memory and keep
+    # the disk write off the event loop
+    data = bytearray()
+    async for piece in request.stream():
+        data += piece
+        if len(data) > UPLOAD_CHUNK_BYTES:
+            raise HTTPException(status_code=413, detail="Chunk larger than chunkSizeBytes")
+    size = len(data)
+    entry = _pending_uploads.get(upload_id)
+    if entry:
+        # Activity keeps a long upload alive; the TTL only reaps idle ones
+        _pending_uploads[upload_id] = (entry[0], now_ms())
+    # Write to a temp name and rename, so a retried or interrupted PUT never
+    # leaves a half-written chunk behind.
+    part = d / f"{idx}.{new_id()}.part"
+    try:
+        await asyncio.to_thread(_write_chunk, part, d / f"{idx}.bin", data)
+    except FileNotFoundError:
+        # Upload was completed or dropped while this chunk was in flight
+        raise HTTPException(status_code=404, detail="Upload not found")
+    finally:
+        part.unlink(missing_ok=True)
+    return {"ok": True, "sizeBytes": size}
+
+@app.post("/api/uploads/audio/chunked/{upload_id}/complete", response_model=UploadAudioResponse)
+async def chunked_upload_complete(upload_id: str, req: ChunkedUploadCompleteRequest, _: None = Depends(require_admin)):
+    d = _pending_dir(upload_id)
+    missing = [idx for idx in range(req.chunks) if not (d / f"{idx}.bin").is_file()]
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Missing chunks: {missing[:20]}")
+    ext = _pending_uploads.pop(upload_id)[0]
+    tmp = tempfile.NamedTemporaryFile(dir=BLOB_DIR, suffix=ext, delete=False)
+    try:
+        with tmp:
+            tmp_size = await asyncio.to_thread(_concat_chunks, d, req.chunks, tmp)
+    except BaseException:
+        Path(tmp.name).unlink(missing_ok=True)
+        raise
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+    return await _store_upload(tmp.name, tmp_size)
+
+
+_BLOB_CONTENT_TYPE_SQL = "SELECT content_type FROM audio_blobs WHERE blob_key = ?"
+
+@app.get("/api/devices/{device_id}/audio/{blob_key}")
+async def get_audio(device_id: str, blob_key: str, req: Request, exp: Optional[str] = None, sig: Optional[str] = None):
+    if sig and exp and audio_url_valid(device_id, blob_key, exp, sig):
+        # We issued this exact URL; every stored blob is WAV, so skip the DB too
+        content_type = "audio/wav"
     else:
-        await db_exec(
-            "UPDATE messages SET state = 'expired' WHERE state = 'queued' AND expires_at <= ?",
-            (now_iso,)
+        await require_device_or_admin(req, device_id=device_id)
+        row = await db_fetchone(_BLOB_CONTENT_TYPE_SQL, (blob_key,))
+        if not row:
+            raise HTTPException(status_code=404, detail="Not found")
+        content_type = row["content_type"]
+    if ACCEL_REDIRECT_PREFIX and req.headers.get("x-accel-enabled") == "1":
+        # The proxy opens the file itself and 404s if it's gone
+        return Response(
+            media_type=content_type,
+            headers={"X-Accel-Redirect": f"{ACCEL_REDIRECT_PREFIX}/{blob_relpath(blob_key)}"},
         )
+    fp = blob_path(blob_key)
+    # One stat, reused by FileResponse for Content-Length/ETag instead of its own
+    try:
+        st = os.stat(fp)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Missing blob file")
+    return FileResponse(fp, stat_result=st, media_type=content_type, filename=os.path.basename(fp))
+
+# HEAD shares the handler (FileResponse sends headers only) but stays out of the
+# OpenAPI schema, where it would duplicate the GET's operationId.
+app.head("/api/devices/{device_id}/audio/{blob_key}", include_in_schema=False)(get_audio)
 
-async def fetch_next_message(device_id: str) -> Optional[sqlite3.Row]:
-    await expire_queued_messages(device_id=device_id)
-    return await db_fetchone(
-        "SELECT * FROM messages WHERE device_id = ? AND state = 'queued' AND expires_at > ? ORDER BY created_at ASC LIMIT 1",
-        (device_id, dt_to_iso(utcnow()))
+# -----------------------------
+# Messaging helpers
+# -----------------------------
+async def expire_queued_messages() -> None:
+    await db_exec(
+        "UPDATE messages SET state = 'expired' WHERE state = 'queued' AND expires_at <= ?",
+        (now_ms(),)
     )
 
-def build_audio_url(device_id: str, blob_key: str) -> str:
-    # Keep it simple: authenticated URL. Client passes bearer token.
-    return f"/api/devices/{device_id}/audio/{blob_key}"
+# Picking and marking delivered in one statement means two concurrent polls for
+# the same device can never both get the same message. Expired rows are skipped
+# here and flipped to 'expired' by the periodic sweep. The unary + keeps the
+# planner on idx_messages_queued (already in claim order) instead of scanning
+# idx_messages_state_expires across all devices.
+# Urgent messages jump the queue: 'urgent' sorts after 'normal', so DESC puts
+# them first, oldest first within each priority.
+_CLAIM_NEXT_SQL = """
+    UPDATE messages SET state = 'delivered'
+    WHERE message_id IN (
+        SELECT message_id FROM messages
+        WHERE device_id = ? AND state = 'queued' AND +expires_at > ?
+        ORDER BY priority DESC, created_at ASC LIMIT ?
+    )
+    RETURNING *
+"""
+MAX_MESSAGES_PER_POLL = 50
+
+async def claim_next_message(device_id: str) -> Optional[sqlite3.Row]:
+    return await db_exec_fetchone(_CLAIM_NEXT_SQL, (device_id, now_ms(), 1))
+
+async def claim_next_messages(device_id: str, limit: int) -> list[sqlite3.Row]:
+    # RETURNING order is unspecified; restore the claim order
+    rows = await db_exec_fetchall(_CLAIM_NEXT_SQL, (device_id, now_ms(), limit))
+    rows.sort(key=lambda r: (r["priority"] != "urgent", r["created_at"]))
+    return rows
+
+def _audio_sig(device_id: str, blob_key: str, exp: int) -> str:
+    msg = f"{device_id}/{blob_key}/{exp}".encode()
+    return hmac.new(AUDIO_URL_SECRET, msg, hashlib.sha256).hexdigest()[:32]
+
+def audio_url_valid(device_id: str, blob_key: str, exp: str, sig: str) -> bool:
+    # exp comes straight from the query string; anything malformed just means
+    # "not signed", so the caller falls back to bearer auth instead of a 422
+    if not (exp.isascii() and exp.isdigit()):
+        return False
+    exp_ms = int(exp)
+    return exp_ms > now_ms() and hmac.compare_digest(_audio_sig(device_id, blob_key, exp_ms).encode(), sig.encode())
+
+def build_audio_url(device_id: str, blob_key: str, exp: int) -> str:
+    # Signed until exp (the message's expiry, epoch ms) so the download needs no
+    # auth or DB lookup; the client's bearer token still works without it.
+    return f"/api/devices/{device_id}/audio/{blob_key}?exp={exp}&sig={_audio_sig(device_id, blob_key, exp)}"
+
+def next_message_response(row: sqlite3.Row) -> dict:
+    # Plain dict in NextMessageResponse's shape; the long-poll hands it straight
+    # to ORJSONResponse instead of building and re-validating a model per message
+    return {
+        "messageId": row["message_id"],
+        "type": row["type"],
+        "text": row["text"],
+        "audioUrl": row["audio_url"],
+        "audioBlobKey": row["audio_blob_key"],
+        "priority": row["priority"],
+        "createdAt": ms_to_iso(row["created_at"]),
+        "expiresAt": ms_to_iso(row["expires_at"]),
+    }
 
 # -----------------------------
 # Enqueue message (admin)
 # -----------------------------
+_INSERT_MESSAGE_SQL = """
+    INSERT INTO messages(message_id, device_id, type, text, audio_blob_key, priority, created_at, expires_at, state, details, audio_url)
+    VALUES(?,?,?,?,?,?,?,?,?,?,?)
+"""
+
 @app.post("/api/devices/{device_id}/messages", response_model=EnqueueMessageResponse)
 async def enqueue_message(device_id: str, req: EnqueueMessageRequest, _: None = Depends(require_admin)):
-    # validate device exists
-    dev = await db_fetchone("SELECT device_id FROM devices WHERE device_id = ?", (device_id,))
-    if not dev:
-        raise HTTPException(status_code=404, detail="Device not found")
-
     if req.type == "tts":
         if not req.text or not req.text.strip():
             raise HTTPException(status_code=400, detail="text is required for type=tts")
     elif req.type == "audio":
         if not req.audioBlobKey:
             raise HTTPException(status_code=400, detail="audioBlobKey is required for type=audio")
-        blob = await db_fetchone("SELECT blob_key FROM audio_blobs WHERE blob_key = ?", (req.audioBlobKey,))
-        if not blob:
-            raise HTTPException(status_code=400, detail="audioBlobKey not found")
 
-    created = utcnow()
+    created = now_ms()
     if req.expiresAt:
-        expires = iso_to_dt(req.expiresAt)
+        expires = dt_to_ms(iso_to_dt(req.expiresAt))
     else:
         ttl = req.ttlSeconds if req.ttlSeconds is not None else DEFAULT_MESSAGE_TTL_SECONDS
         if ttl <= 0 or ttl > 24 * 3600:
             raise HTTPException(status_code=400, detail="ttlSeconds must be between 1 and 86400")
-        expires = created + timedelta(seconds=ttl)
+        expires = created + ttl * 1000
 
     if expires <= created:
         raise HTTPException(status_code=400, detail="expiresAt must be in the future")
 
-    message_id = str(uuid.uuid4())
-    await db_exec(
-        """INSERT INTO messages(message_id, device_id, type, text, audio_blob_key, priority, created_at, expires_at, state, details)
-           VALUES(?,?,?,?,?,?,?,?,?,?)""",
-        (
-            message_id, device_id, req.type,
-            (req.text.strip() if req.text else None),
-            req.audioBlobKey,
-            req.priority,
-            dt_to_iso(created),
-            dt_to_iso(expires),
-            "queued",
-            None
+    message_id = new_id()
+    try:
+        await db_exec(
+            _INSERT_MESSAGE_SQL,
+            (
+                message_id, device_id, req.type,
+                (req.text.strip() if req.text else None),
+                req.audioBlobKey,
+                req.priority,
+                created,
+                expires,
+                "queued",
+                None,
+                # Signed once here rather than on every delivery
+                (build_audio_url(device_id, req.audioBlobKey, expires) if req.type == "audio" else None),
+            )
         )
-    )
+    except sqlite3.IntegrityError:
+        # The foreign keys validate device and blob in the INSERT itself; SQLite
+        # doesn't say which one failed, so only this rare path looks it up.
+        dev = await db_fetchone("SELECT 1 FROM devices WHERE device_id = ?", (device_id,))
+        if not dev:
+            raise HTTPException(status_code=404, detail="Device not found")
+        raise HTTPException(status_code=400, detail="audioBlobKey not found")
     # Wake any long-poll for that device
-    await notify_device(device_id)
-    return EnqueueMessageResponse(messageId=message_id, expiresAt=dt_to_iso(expires))
+    notify_device(device_id)
+    return EnqueueMessageResponse(messageId=message_id, expiresAt=ms_to_iso(expires))
 
 # -----------------------------
 # Long poll next message (device)
 # -----------------------------
-@app.get("/api/devices/{device_id}/messages/next", response_model=NextMessageResponse, responses={204: {"description": "No Content"}})
-async def messages_next(device_id: str, request: Request, timeout: int = LONGPOLL_TIMEOUT_SECONDS, ctx: DeviceContext = Depends(require_device)):
+async def _wait_for_disconnect(request: Request) -> None:
+    # A long-poll GET has at most an empty body message; after that the only
+    # thing receive() can deliver is the disconnect
+    while (await request.receive())["type"] != "http.disconnect":
+        pass
+
+@app.get("/api/devices/{device_id}/messages/next", response_model=Union[NextMessageResponse, NextMessagesResponse], responses={204: {"description": "No Content"}})
+async def messages_next(
+    device_id: str,
+    request: Request,
+    timeout: int = LONGPOLL_TIMEOUT_SECONDS,
+    max_messages: Optional[int] = Query(None, alias="max"),
+    ctx: DeviceContext = Depends(require_device),
+):
+    """Long-poll for the next queued message.
+
+    With ?max=N the response is {"messages": [...]} holding up to N messages,
+    so a client can drain a burst in one round-trip; without it the response
+    is a single message (what the Windows agent expects).
+    """
     # timeout clamp
     if timeout < 1:
         timeout = 1
     if timeout > 120:
         timeout = 120
-
-    # Fast path: check immediately
-    row = await fetch_next_message(device_id)
-    if row:
-        # Mark delivered (optional)
-        await db_exec("UPDATE messages SET state = 'delivered' WHERE message_id = ? AND state = 'queued'", (row["message_id"],))
-        return NextMessageResponse(
-            messageId=row["message_id"],
-            type=row["type"],
-            text=row["text"],
-            audioBlobKey=row["audio_blob_key"],
-            audioUrl=(build_audio_url(device_id, row["audio_blob_key"]) if row["type"] == "audio" and row["audio_blob_key"] else None),
-            priority=row["priority"],
-            createdAt=row["created_at"],
-            expiresAt=row["expires_at"],
-        )
-
-    # Wait on condition
-    cond = await _get_condition(device_id)
-    deadline = time.monotonic() + timeout
-    while True:
-        remaining = deadline - time.monotonic()
-        if remaining <= 0:
-            return Response(status_code=204)
-
-        # If client disconnected, stop early
-        if await request.is_disconnected():
-            return Response(status_code=204)
-
-        async with cond:
-            try:
-                await asyncio.wait_for(cond.wait(), timeout=remaining)
-            except asyncio.TimeoutError:
+    if max_messages is not None:
+        max_messages = min(max(max_messages, 1), MAX_MESSAGES_PER_POLL)
+
+    async def claim():
+        if max_messages is None:
+            row = await claim_next_message(device_id)
+            return next_message_response(row) if row else None
+        rows = await claim_next_messages(device_id, max_messages)
+        return {"messages": [next_message_response(r) for r in rows]} if rows else None
+
+    # Register before the first check: anything enqueued after it wakes us
+    waiter = _add_waiter(device_id)
+    disconnected = None
+    try:
+        # Fast path: check immediately
+        resp = await claim()
+        if resp:
+            return ORJSONResponse(resp)
+
+        # Wait for an enqueue to signal the device, racing one long-lived
+        # disconnect watcher instead of polling is_disconnected() every round
+        deadline = time.monotonic() + timeout
+        disconnected = asyncio.create_task(_wait_for_disconnect(request))
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
                 return Response(status_code=204)
 
-        # after notify, check again
-        row = await fetch_next_message(device_id)
-        if row:
-            await db_exec("UPDATE messages SET state = 'delivered' WHERE message_id = ? AND state = 'queued'", (row["message_id"],))
-            return NextMessageResponse(
-                messageId=row["message_id"],
-                type=row["type"],
-                text=row["text"],
-                audioBlobKey=row["audio_blob_key"],
-                audioUrl=(build_audio_url(device_id, row["audio_blob_key"]) if row["type"] == "audio" and row["audio_blob_key"] else None),
-                priority=row["priority"],
-                createdAt=row["created_at"],
-                expiresAt=row["expires_at"],
+            await asyncio.wait(
+                (waiter, disconnected), timeout=remaining, return_when=asyncio.FIRST_COMPLETED
             )
+            if not waiter.done() or disconnected.done():
+                # Timed out, or the client went away (even if a notify landed in
+                # the same round: claiming now would hand the message to nobody;
+                # _drop_waiter passes that wakeup on)
+                return Response(status_code=204)
+
+            # after notify, check again (re-registered first, as above)
+            waiter = _add_waiter(device_id)
+            resp = await claim()
+            if resp:
+                return ORJSONResponse(resp)
+    finally:
+        if disconnected is not None:
+            disconnected.cancel()
+        _drop_waiter(device_id, waiter)
 
 # -----------------------------
 # ACK (device)
 # -----------------------------
+_ACK_LOOKUP_SQL = "SELECT device_id FROM messages WHERE message_id = ?"
+# The expiry rule lives in the UPDATE so the reported state is whatever was
+# actually written: anything but 'played' on an expired message becomes 'expired'.
+_ACK_UPDATE_SQL = """
+    UPDATE messages
+    SET state = CASE WHEN ?1 != 'played' AND expires_at <= ?2 THEN 'expired' ELSE ?1 END,
+        details = ?3
+    WHERE message_id = ?4
+    RETURNING state
+"""
+ACK_BATCH_MAX = 256
+_ack_queue: Optional[asyncio.Queue] = None  # created on startup, on the serving loop
+
+async def _write_acks() -> None:
+    # Acks that arrive while a batch is being written go out together in the
+    # next one, so a burst costs one commit instead of one per message.
+    while True:
+        batch = [await _ack_queue.get()]
+        while len(batch) < ACK_BATCH_MAX and not _ack_queue.empty():
+            batch.append(_ack_queue.get_nowait())
+        exc = None
+        try:
+            rows = await db_exec_fetchone_each(_ACK_UPDATE_SQL, [params for params, _ in batch])
+        except asyncio.CancelledError:
+            for _, fut in batch:
+                fut.cancel()
+            raise
+        except Exception as e:
+            # Fail this batch's acks, but keep the task alive for the next ones
+            exc = e
+        for i, (_, fut) in enumerate(batch):
+            if fut.done():
+                continue  # that request was cancelled meanwhile
+            if exc is None:
+                fut.set_result(rows[i])
+            else:
+                fut.set_exception(exc)
+
+async def write_ack(status: str, details: Optional[str], message_id: str) -> Optional[sqlite3.Row]:
+    """Queue an ack for the next batch; returns the UPDATE's RETURNING row."""
+    fut = asyncio.get_running_loop().create_future()
+    _ack_queue.put_nowait(((status, now_ms(), details, message_id), fut))
+    return await fut
+
 @app.post("/api/messages/{message_id}/ack")
 async def ack_message(message_id: str, req: AckRequest, request: Request):
     # We need to verify the device token belongs to the message's device.
-    token = _bearer_token(request)
-    if not token:
+    if not _bearer_token(request):
         raise HTTPException(status_code=401, detail="Unauthorized (device)")
 
-    msg = await db_fetchone("SELECT message_id, device_id, state, expires_at FROM messages WHERE message_id = ?", (message_id,))
+    msg = await db_fetchone(_ACK_LOOKUP_SQL, (message_id,))
     if not msg:
         raise HTTPException(status_code=404, detail="Message not found")
 
-    dev = await db_fetchone("SELECT device_token FROM devices WHERE device_id = ?", (msg["device_id"],))
-    if not dev or dev["device_token"] != token:
-        raise HTTPException(status_code=401, detail="Unauthorized (device)")
-
-    now = utcnow()
-    # If message already expired, force expired state unless it was played
-    expired = iso_to_dt(msg["expires_at"]) <= now
+    # Same cached, constant-time check as the long-poll
+    await require_device(request, device_id=msg["device_id"])
 
-    new_state = None
-    if req.status == "played":
-        new_state = "played"
-    elif req.status == "failed":
-        new_state = "failed"
-    elif req.status == "expired":
-        new_state = "expired"
-
-    if expired and new_state != "played":
-        new_state = "expired"
-
-    await db_exec("UPDATE messages SET state = ?, details = ? WHERE message_id = ?", (new_state, req.details, message_id))
-    return {"ok": True, "state": new_state}
+    row = await write_ack(req.status, req.details, message_id)
+    if not row:
+        raise HTTPException(status_code=404, detail="Message not found")
+    return {"ok": True, "state": row["state"]}
 
 # -----------------------------
 # Health
 # -----------------------------
+_healthz_body: tuple[int, bytes] = (0, b"")
+
 @app.get("/healthz")
 async def healthz():
-    return {"ok": True, "time": dt_to_iso(utcnow())}
+    # Probes only need a live clock: render the body once per second, lazily,
+    # rather than formatting and serializing it on every hit
+    global _healthz_body
+    sec = int(time.time())
+    if _healthz_body[0] != sec:
+        _healthz_body = (sec, ORJSONResponse({"ok": True, "time": ms_to_iso(sec * 1000)}).body)
+    return Response(content=_healthz_body[1], media_type="application/json")
@@ -0,0 +1,29 @@
+// AudioWorklet that copies raw mic samples (first channel) out of the audio
+// thread in 4096-frame batches. The page turns them into a WAV file.
+class PcmRecorderProcessor extends AudioWorkletProcessor {
+  constructor() {
+    super();
+    this.buf = new Float32Array(4096);
+    this.len = 0;
+    // Any message from the page means "recording stopped": send what's left.
+    this.port.onmessage = () => this.flush(true);
+  }
+
+  flush(done) {
+    const samples = this.buf.slice(0, this.len);
+    this.port.postMessage({ samples, done }, [samples.buffer]);
+    this.len = 0;
+  }
+
+  process(inputs) {
+    const ch = inputs[0] && inputs[0][0];
+    if (ch) {
+      if (this.len + ch.length > this.buf.length) this.flush(false);
+      this.buf.set(ch, this.len);
+      this.len += ch.length;
+    }
+    return true;
+  }
+}
+
+registerProcessor("pcm-recorder", PcmRecorderProcessor);